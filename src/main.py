@@ -1,84 +1,386 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+import atexit
+import hashlib
+import hmac
+import logging
 import os
-import requests
-from typing import Dict, Any, List
-
-app = FastAPI()
+import queue
+import time
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
+from pydantic import BaseModel, ValidationError
+from redis import asyncio as redis_asyncio
+from redis.exceptions import RedisError
+from typing import Dict, Any, List, Set, Tuple
 
 # ===== ENV VARS =====
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN", "")
+REDIS_URL = os.getenv("REDIS_URL", "")
+# Redis sits on the hot path; a hung one must fail over to Supabase fast
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))  # seconds
+# Sent back by Telegram as X-Telegram-Bot-Api-Secret-Token on every update
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+# Public URL of /telegram-webhook; when set, startup (re)registers it
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+# Comma-separated bot ids loaded in one Supabase call at startup, so the
+# first users after a deploy don't each pay a cold config fetch
+WARM_BOT_IDS = [b.strip() for b in os.getenv("WARM_BOT_IDS", "").split(",") if b.strip()]
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_PER_MIN = float(os.getenv("RATE_LIMIT_PER_MIN", "30"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+MAX_UPDATE_BYTES = int(os.getenv("MAX_UPDATE_BYTES", "262144"))  # 256 KB; real updates are a few KB
+# Telegram pool: connections kept alive, and how long a send may wait for one
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "32"))
+TG_POOL_TIMEOUT = float(os.getenv("TG_POOL_TIMEOUT", "5.0"))  # seconds
+# Updates handled at once; the rest wait on UPDATE_SLOTS instead of all
+# piling onto the Supabase / Telegram pools during a burst
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+# How long shutdown waits for updates that were acked but not yet answered
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "10.0"))  # seconds
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "1.0"))  # seconds
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
 
+# ===== LOGGING =====
+# Lazy %-formatting throughout: with the default WARNING level the per-update
+# debug lines cost a level check, not a repr() of the whole update + write().
+logger = logging.getLogger("acspro")
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    # The event loop only enqueues records; a listener thread does the
+    # blocking stderr write, so a slow log sink can't stall webhooks.
+    _log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _log_listener = QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)  # drains what's still queued
+    logger.addHandler(QueueHandler(_log_queue))
+    logger.propagate = False
+
+# ===== HTTP CLIENTS =====
+# Opened in lifespan() below. Both pool keep-alive + HTTP/2 connections so
+# calls reuse one TLS session instead of a fresh handshake each time.
+TG_HTTP: httpx.AsyncClient | None = None    # Bot API
+SUPA_HTTP: httpx.AsyncClient | None = None  # Supabase REST, service role
+
+# Optional shared cache so every uvicorn worker (and the next deploy)
+# sees the same bot configs. Without REDIS_URL we stay in-process only.
+REDIS: redis_asyncio.Redis | None = None
+
 # ===== SIMPLE CACHE =====
-BOT_CACHE: Dict[str, Dict[str, Any]] = {}   # bot_id -> config_json
-MENU_CACHE: Dict[str, List[Dict[str, Any]]] = {}  # bot_id -> menu structure
+BOT_CACHE_TTL = 60.0  # seconds; dashboard edits show up within a minute
+# A worker can copy a Redis entry just before it expires and keep it for its
+# whole local TTL, so with Redis the minute is split between the two layers.
+LOCAL_BOT_TTL = BOT_CACHE_TTL / 2 if REDIS_URL else BOT_CACHE_TTL
+REDIS_BOT_TTL = BOT_CACHE_TTL - LOCAL_BOT_TTL
+BOT_CACHE: "TTLCache[str, BotCfg]" = TTLCache(maxsize=10_000, ttl=LOCAL_BOT_TTL)  # bot_id -> normalized config
+# Keyed by config digest rather than bot_id: a TTL refresh that returns the
+# same config reuses the built menu, and an edited config can never hit a
+# stale one. Bounded LRU, old digests just age out.
+MENU_CACHE_SIZE = 128
+MENU_CACHE: "LRUCache[bytes, Dict[str, Any]]" = LRUCache(maxsize=MENU_CACHE_SIZE)  # digest -> index_menu() result
+CACHE_STATS: Dict[str, int] = {"bot_hit": 0, "bot_miss": 0, "menu_hit": 0, "menu_miss": 0}
+# One in-flight fetch per bot: concurrent misses (a new bot's first burst,
+# or right after the TTL lapses) await the same task instead of each
+# going to Redis / Supabase.
+BOT_LOADS: Dict[str, asyncio.Task] = {}
+
+# ===== CHAT → BOT MAPPING =====
+# Mappings this process wrote, queued or read back, so a burst of messages
+# skips the telegram_sessions GET. Kept short: a /start on another worker
+# moves the chat to another restaurant, and this copy must not outlive that
+# for long. With Redis the switch is published there (CHAT_REDIS_TTL) and
+# the local copy only absorbs bursts; without it the next read is Supabase.
+CHAT_TO_BOT_TTL = 5.0 if REDIS_URL else 30.0  # seconds
+CHAT_REDIS_TTL = 3600.0  # seconds
+CHAT_TO_BOT: "TTLCache[int, str]" = TTLCache(maxsize=100_000, ttl=CHAT_TO_BOT_TTL)
+# Write-behind queue, flushed as one bulk upsert every SESSION_FLUSH_INTERVAL.
+# A dict rather than a Queue: several /starts in one interval collapse to
+# the latest bot_id per chat.
+PENDING_SESSIONS: Dict[int, str] = {}
+# Rows Supabase rejected (4xx) are retried alone, and dropped after this
+# many rejections so one bad row can't be re-sent forever.
+SESSION_MAX_REJECTS = 3
+SESSION_REJECTS: Dict[int, int] = {}  # chat_id -> rejections so far
+
+# ===== RATE LIMIT =====
+# A bucket idle long enough to refill completely is the same as no bucket,
+# so entries expire then instead of piling up one per chat ever seen.
+RATE_BUCKET_TTL = RATE_LIMIT_BURST * 60 / RATE_LIMIT_PER_MIN if RATE_LIMIT_PER_MIN > 0 else 3600.0  # seconds
+RATE_BUCKETS: "TTLCache[int, Tuple[float, float]]" = TTLCache(maxsize=100_000, ttl=RATE_BUCKET_TTL)  # chat_id -> (tokens, last_seen)
+
+# ===== BACKGROUND TASKS =====
+# The event loop only keeps weak refs to tasks, so hold them until done.
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+UPDATE_SLOTS: asyncio.Semaphore | None = None  # created in lifespan(), on the serving loop
+
+
+# ============================================================
+#   APP LIFECYCLE
+# ============================================================
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the shared clients (and UPDATE_SLOTS) on startup, closes them on shutdown."""
+    global TG_HTTP, SUPA_HTTP, REDIS, UPDATE_SLOTS
+    UPDATE_SLOTS = asyncio.Semaphore(UPDATE_CONCURRENCY)
+    TG_HTTP = httpx.AsyncClient(
+        base_url=TELEGRAM_API_URL,
+        http2=True,
+        timeout=httpx.Timeout(10.0, pool=TG_POOL_TIMEOUT),
+        limits=httpx.Limits(max_keepalive_connections=TG_POOL_SIZE),
+    )
+    SUPA_HTTP = httpx.AsyncClient(
+        base_url=f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+        headers={
+            "apikey": SUPABASE_SERVICE_ROLE_KEY,
+            "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+        },
+        http2=True,
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=16),
+    )
+    if REDIS_URL:
+        # Bounded so a Redis that accepts but never answers raises
+        # TimeoutError (a RedisError the helpers already handle)
+        REDIS = redis_asyncio.Redis.from_url(
+            REDIS_URL,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT,
+        )
+    if TELEGRAM_WEBHOOK_URL:
+        await register_webhook()
+    if WARM_BOT_IDS:
+        await warm_bot_cache(WARM_BOT_IDS)
+    flusher = asyncio.create_task(session_flush_loop())
+
+    try:
+        yield
+    finally:
+        # Telegram won't redeliver updates we already acked, so let them
+        # finish before the clients they reply through are closed
+        await drain_background_tasks(SHUTDOWN_GRACE)
+        flusher.cancel()
+        # A flush cut off mid-write re-queues its batch on the way out
+        await asyncio.gather(flusher, return_exceptions=True)
+        await flush_pending_sessions()  # don't drop mappings queued at shutdown
+        await TG_HTTP.aclose()
+        await SUPA_HTTP.aclose()
+        if REDIS is not None:
+            await REDIS.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 # ============================================================
 #   SUPABASE HELPERS
 # ============================================================
 
-def supabase_get(path: str, params=None):
+JSON_HEADERS = {"Content-Type": "application/json"}
+UPSERT_HEADERS = {**JSON_HEADERS, "Prefer": "resolution=merge-duplicates"}
+
+
+async def supabase_get(path: str, params=None):
     """GET wrapper using service role."""
-    headers = {
-        "apikey": SUPABASE_SERVICE_ROLE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-    }
-    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{path}"
-    resp = requests.get(url, params=params, headers=headers)
+    resp = await SUPA_HTTP.get(path, params=params)
 
     if resp.status_code >= 300:
-        print("⚠ Supabase GET error:", resp.status_code, resp.text)
+        logger.warning("Supabase GET %s failed: %s %s", path, resp.status_code, resp.text)
         return None
-    return resp.json()
+    return orjson.loads(resp.content)
 
 
-def supabase_upsert(path: str, json_body: dict):
-    headers = {
-        "apikey": SUPABASE_SERVICE_ROLE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "resolution=merge-duplicates"
-    }
-    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{path}"
-    resp = requests.post(url, json=json_body, headers=headers)
+async def supabase_upsert(path: str, json_body: dict | list):
+    """Returns the parsed body ([] when empty), or None if Supabase rejected it.
 
+    Server errors (5xx) raise httpx.HTTPStatusError like a network error
+    would: the rows were fine, so the caller should simply retry them.
+    """
+    resp = await SUPA_HTTP.post(path, content=orjson.dumps(json_body), headers=UPSERT_HEADERS)
+
+    if resp.status_code >= 500:
+        resp.raise_for_status()
     if resp.status_code >= 300:
-        print("❌ Supabase UPSERT Error:", resp.status_code, resp.text)
+        logger.error("Supabase UPSERT %s failed: %s %s", path, resp.status_code, resp.text)
         return None
 
     # SAFE PARSE
     try:
-        return resp.json()
+        return orjson.loads(resp.content)
     except:
+        return []
+
+# ============================================================
+#   REDIS HELPERS
+# ============================================================
+
+REDIS_BOT_KEY = "acspro:bot:{}"
+REDIS_CHAT_KEY = "acspro:chat:{}"  # -> bot_id
+
+
+async def redis_get_json(key: str):
+    """Returns the decoded value, or None on miss / no Redis / Redis down."""
+    if REDIS is None:
         return None
+    try:
+        raw = await REDIS.get(key)
+    except RedisError as e:
+        logger.warning("Redis GET failed: %s", e)
+        return None
+    return orjson.loads(raw) if raw else None
+
+
+async def redis_set_json(key: str, value, ttl: float, nx: bool = False):
+    """nx=True only writes if key is absent, for read-populates that must
+    not clobber a fresher value another worker just wrote."""
+    if REDIS is None:
+        return
+    try:
+        await REDIS.set(key, orjson.dumps(value), ex=int(ttl), nx=nx)
+    except RedisError as e:
+        logger.warning("Redis SET failed: %s", e)
+
+
+async def redis_delete(key: str):
+    if REDIS is None:
+        return
+    try:
+        await REDIS.delete(key)
+    except RedisError as e:
+        logger.warning("Redis DELETE failed: %s", e)
+
+
+async def redis_delete_pattern(pattern: str):
+    """SCANs the whole keyspace; only for flush-everything, never one known key."""
+    if REDIS is None:
+        return
+    try:
+        keys = [k async for k in REDIS.scan_iter(match=pattern)]
+        if keys:
+            await REDIS.delete(*keys)
+    except RedisError as e:
+        logger.warning("Redis DELETE failed: %s", e)
 
 # ============================================================
 #   BOT CONFIG LOADING
 # ============================================================
 
-def load_bot_config(bot_id: str) -> Dict[str, Any]:
-    """Loads config_json from Supabase, cached."""
-    if bot_id in BOT_CACHE:
-        return BOT_CACHE[bot_id]
+@dataclass(slots=True, frozen=True)
+class BotCfg:
+    """config_json normalized once per load; handlers read plain attributes."""
+    restaurant_name: str
+    tagline: str
+    opening_hours: str
+    digest: bytes
+    menu: Dict[str, Any]  # index_menu() result, shared through MENU_CACHE
+    welcome_html: str  # /start greeting, rendered once per load
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "BotCfg":
+        digest = config_digest(config)
+        restaurant_name = config.get("restaurantName") or ""
+        tagline = config.get("restaurantTagline") or ""
+        opening_hours = config.get("openingHours") or ""
+        return cls(
+            restaurant_name=restaurant_name,
+            tagline=tagline,
+            opening_hours=opening_hours,
+            digest=digest,
+            menu=menu_for_config(digest, config),
+            welcome_html=build_welcome_text(restaurant_name, tagline, opening_hours),
+        )
+
+
+async def load_bot_config(bot_id: str) -> BotCfg | None:
+    """Loads config_json as a BotCfg, at most BOT_CACHE_TTL seconds stale.
+
+    Lookup order: this process, then Redis (shared by all workers),
+    then Supabase. Returns None for unknown bots or an empty config.
+    """
+    cached = BOT_CACHE.get(bot_id)
+    if cached is not None:
+        CACHE_STATS["bot_hit"] += 1
+        return cached
+    CACHE_STATS["bot_miss"] += 1
+
+    task = BOT_LOADS.get(bot_id)
+    if task is None:
+        task = asyncio.create_task(fetch_bot_config(bot_id))
+        BOT_LOADS[bot_id] = task
+        task.add_done_callback(lambda _: BOT_LOADS.pop(bot_id, None))
+    # Shielded so one cancelled caller doesn't cancel the others' fetch
+    return await asyncio.shield(task)
+
+
+async def fetch_bot_config(bot_id: str) -> BotCfg | None:
+    """The miss path of load_bot_config(); only ever one per bot at a time."""
+    config = await redis_get_json(REDIS_BOT_KEY.format(bot_id))
+    if not isinstance(config, dict):
+        rows = await supabase_get("bots", {
+            "id": f"eq.{bot_id}",
+            "select": "config_json"
+        })
+        if not rows:
+            logger.warning("No bot found: %s", bot_id)
+            return None
 
-    rows = supabase_get("bots", {
-        "id": f"eq.{bot_id}",
-        "select": "config_json"
-    })
-    if not rows:
-        print("⚠ No bot found:", bot_id)
-        return {}
+        config = rows[0].get("config_json") or {}
+        if not isinstance(config, dict):
+            config = {}
+        await redis_set_json(REDIS_BOT_KEY.format(bot_id), config, REDIS_BOT_TTL)
+
+    return cache_bot_config(bot_id, config)
+
+
+async def warm_bot_cache(bot_ids: List[str]):
+    """Loads several bots into BOT_CACHE with one id=in.(...) request."""
+    quoted = ",".join(f'"{b}"' for b in bot_ids)
+    try:
+        rows = await supabase_get("bots", {"id": f"in.({quoted})", "select": "id,config_json"})
+    except httpx.HTTPError as e:
+        # Only a warm-up; the bots still load on demand
+        logger.warning("Warming bot cache failed: %r", e)
+        return
+    for row in rows or []:
+        cache_bot_config(row["id"], row.get("config_json"))
+
+
+def cache_bot_config(bot_id: str, config) -> BotCfg | None:
+    """Normalizes a fetched config_json and stores it in BOT_CACHE."""
+    if not isinstance(config, dict) or not config:
+        return None
+
+    cfg = BotCfg.from_config(config)
+    BOT_CACHE[bot_id] = cfg
+    return cfg
+
+
+def config_digest(config: Dict[str, Any]) -> bytes:
+    """Cheap, stable fingerprint of a config_json (sorted keys)."""
+    return hashlib.blake2b(orjson.dumps(config, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
 
-    config = rows[0].get("config_json") or {}
-    if not isinstance(config, dict):
-        config = {}
 
-    BOT_CACHE[bot_id] = config
-    return config
+async def flush_bot_cache(bot_id: str | None = None):
+    """Drops cached config + menu for one bot, or for all bots."""
+    # Only clears this worker's memory; the others expire within LOCAL_BOT_TTL
+    if bot_id:
+        BOT_CACHE.pop(bot_id, None)
+        # Exact key, so a bot_id containing "*" can't act as a pattern
+        await redis_delete(REDIS_BOT_KEY.format(bot_id))
+    else:
+        BOT_CACHE.clear()
+        MENU_CACHE.clear()
+        await redis_delete_pattern(REDIS_BOT_KEY.format("*"))
 
 
 def build_menu(config: Dict[str, Any]) -> List[Dict[str, Any]]:
@@ -135,22 +437,185 @@ def build_menu(config: Dict[str, Any]) -> List[Dict[str, Any]]:
     ]
 
 
-def get_menu_for_bot(bot_id: str):
-    """Returns menu from cache or Supabase."""
-    if bot_id in MENU_CACHE:
-        return MENU_CACHE[bot_id]
+def price_label(price: float) -> str:
+    return f"{price:.2f}$" if price > 0 else "حسب الطلب"
 
-    config = load_bot_config(bot_id)
-    menu = build_menu(config)
-    MENU_CACHE[bot_id] = menu
+
+def parse_price(value) -> float:
+    """Dashboard prices arrive as numbers or strings ("7"); anything else is 0."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+@dataclass(slots=True, frozen=True)
+class MenuItem:
+    """One menu item, with its card caption and keyboard pre-rendered."""
+    id: str
+    name: str
+    description: str
+    price: float
+    image_url: str
+    caption: str
+    card_keyboard: orjson.Fragment
+
+    @classmethod
+    def from_config(cls, item) -> "MenuItem | None":
+        """None (logged) for an item without an id or name."""
+        if not isinstance(item, dict) or not item.get("id") or not item.get("name"):
+            logger.warning("Skipping malformed menu item: %r", item)
+            return None
+
+        item_id = str(item["id"])
+        name = str(item["name"])
+        description = item.get("description") or ""
+        price = parse_price(item.get("price"))
+        return cls(
+            id=item_id,
+            name=name,
+            description=description,
+            price=price,
+            image_url=item.get("imageUrl") or "",
+            caption=f"<b>{name}</b>\n{description}\n💰 {price_label(price)}",
+            card_keyboard=item_card_keyboard(item_id),
+        )
+
+
+@dataclass(slots=True, frozen=True)
+class MenuCategory:
+    id: str
+    name: str
+    items: Tuple[MenuItem, ...]
+
+    @classmethod
+    def from_config(cls, category) -> "MenuCategory | None":
+        """None (logged) for a category without an id, name or items list.
+
+        Bad items are dropped one by one, so only they go missing.
+        """
+        if (not isinstance(category, dict) or not category.get("id") or not category.get("name")
+                or not isinstance(category.get("items"), list)):
+            logger.warning("Skipping malformed menu category: %r", category)
+            return None
+
+        items = (MenuItem.from_config(it) for it in category["items"])
+        return cls(
+            id=str(category["id"]),
+            name=str(category["name"]),
+            items=tuple(it for it in items if it is not None),
+        )
+
+
+def index_menu(categories: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Pairs the category list with an id lookup and its ready keyboard.
+
+    Categories and items become slotted MenuCategory / MenuItem objects
+    (so config.menu, shared with BOT_CACHE, is never touched), with each
+    card's caption and keyboard built once here rather than on every
+    category view.
+    """
+    categories = [c for c in map(MenuCategory.from_config, categories) if c is not None]
+    return {
+        "categories": categories,
+        "categories_by_id": {c.id: c for c in categories},
+        "categories_keyboard": categories_keyboard(categories),
+    }
+
+
+def menu_for_config(digest: bytes, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds (or reuses, for an unchanged config) the indexed menu."""
+    menu = MENU_CACHE.get(digest)
+    if menu is not None:
+        CACHE_STATS["menu_hit"] += 1
+        return menu
+
+    CACHE_STATS["menu_miss"] += 1
+    try:
+        menu = index_menu(build_menu(config))
+    except Exception:
+        # This runs while the config loads: a menu we can't read must not
+        # stop the bot from answering /start
+        logger.exception("Building menu failed; serving an empty one")
+        menu = index_menu([])
+    MENU_CACHE[digest] = menu
     return menu
 
 
+async def get_menu_for_bot(bot_id: str) -> Dict[str, Any]:
+    """Returns the indexed menu; it is built together with the BotCfg."""
+    cfg = await load_bot_config(bot_id)
+    if cfg is None:
+        # Chat is mapped to a bot whose config has since disappeared
+        return menu_for_config(config_digest({}), {})
+    return cfg.menu
+
+
+# ============================================================
+#   REPLY TEXT
+# ============================================================
+
+def build_welcome_text(restaurant_name: str, tagline: str, opening_hours: str) -> str:
+    """The /start greeting; BotCfg.from_config renders it once per load."""
+    restaurant = restaurant_name or "المطعم"
+    tagline_line = f"✨ {tagline}\n" if tagline else ""
+    opening_line = f"\n⏰ ساعات العمل: {opening_hours}" if opening_hours else ""
+    return (
+        f"👋 أهلاً بك في <b>{restaurant}</b>!\n{tagline_line}{opening_line}"
+        "\n\nاستخدم الأزرار بالأسفل لعرض المنيو 👇"
+    )
+
+
 # ============================================================
 #   TELEGRAM HELPERS
 # ============================================================
 
-def tg_send_message(chat_id: int, text: str, reply_markup=None):
+# Backoff between attempts (3 in all) when the request never left this process
+TG_RETRY_DELAYS = (0.5, 1.0)
+# Longest 429 retry_after we sleep through; past that the send is given up
+TG_MAX_RETRY_AFTER = 30.0  # seconds
+
+
+def tg_retry_after(resp: httpx.Response) -> float:
+    """retry_after from a 429's parameters, 1s if Telegram didn't send one."""
+    try:
+        return float(orjson.loads(resp.content)["parameters"]["retry_after"])
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+        return 1.0
+
+
+async def tg_post(method: str, payload: Dict[str, Any]):
+    """POSTs a Bot API call; the body is encoded with orjson, not httpx's json=.
+
+    Retried: pool and connect timeouts (with backoff) and 429s (after the
+    retry_after Telegram asks for); in both cases nothing was delivered.
+    Read timeouts are not, since Telegram may already have sent the message.
+    """
+    body = orjson.dumps(payload)
+    for delay in (*TG_RETRY_DELAYS, None):
+        try:
+            resp = await TG_HTTP.post(f"/{method}", content=body, headers=JSON_HEADERS)
+        except (httpx.PoolTimeout, httpx.ConnectTimeout) as e:
+            if delay is None:
+                raise
+            logger.warning("Telegram %s: %r, retrying in %ss", method, e, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        if resp.status_code == 429 and delay is not None:
+            retry_after = tg_retry_after(resp)
+            if retry_after <= TG_MAX_RETRY_AFTER:
+                logger.warning("Telegram %s rate limited, retrying in %ss", method, retry_after)
+                await asyncio.sleep(retry_after)
+                continue
+        break
+
+    if resp.status_code >= 400:
+        logger.warning("Telegram %s failed: %s %s", method, resp.status_code, resp.text)
+    return resp
+
+
+async def tg_send_message(chat_id: int, text: str, reply_markup=None):
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -159,10 +624,10 @@ def tg_send_message(chat_id: int, text: str, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = reply_markup
 
-    requests.post(f"{TELEGRAM_API_URL}/sendMessage", json=payload)
+    await tg_post("sendMessage", payload)
 
 
-def tg_send_photo(chat_id: int, url: str, caption="", reply_markup=None):
+async def tg_send_photo(chat_id: int, url: str, caption="", reply_markup=None):
     payload = {
         "chat_id": chat_id,
         "photo": url
@@ -173,178 +638,453 @@ def tg_send_photo(chat_id: int, url: str, caption="", reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = reply_markup
 
-    requests.post(f"{TELEGRAM_API_URL}/sendPhoto", json=payload)
+    await tg_post("sendPhoto", payload)
+
+
+async def register_webhook():
+    """Points Telegram at us, with the secret and only the update types we handle."""
+    payload = {"url": TELEGRAM_WEBHOOK_URL, "allowed_updates": ["message", "callback_query"]}
+    if TELEGRAM_WEBHOOK_SECRET:
+        payload["secret_token"] = TELEGRAM_WEBHOOK_SECRET
+    try:
+        await tg_post("setWebhook", payload)
+    except httpx.HTTPError as e:
+        # Telegram keeps the previous registration; don't fail startup over it
+        logger.warning("Telegram setWebhook failed: %r", e)
+
+
+async def tg_answer_callback(callback_id: str):
+    """Stops the button's loading spinner; best effort, so errors only log."""
+    try:
+        await tg_post("answerCallbackQuery", {"callback_query_id": callback_id})
+    except httpx.HTTPError as e:
+        logger.warning("Telegram answerCallbackQuery failed: %r", e)
 
 
 # ============================================================
 #   TELEGRAM SESSION ASSIGNMENT
 # ============================================================
 
-def assign_chat_to_bot(chat_id: int, bot_id: str):
-    """Writes mapping to telegram_sessions."""
-    supabase_upsert("telegram_sessions", {
-        "telegram_chat_id": str(chat_id),
-        "bot_id": bot_id
-    })
+async def assign_chat_to_bot(chat_id: int, bot_id: str):
+    """Publishes the mapping to Redis and queues it for telegram_sessions.
+
+    Always queued, even if CHAT_TO_BOT already says bot_id: another worker
+    may have moved the chat elsewhere since.
+    """
+    CHAT_TO_BOT[chat_id] = bot_id
+    PENDING_SESSIONS[chat_id] = bot_id
+    await redis_set_json(REDIS_CHAT_KEY.format(chat_id), bot_id, CHAT_REDIS_TTL)
 
 
-def get_bot_for_chat(chat_id: int) -> str | None:
-    rows = supabase_get("telegram_sessions", {
+async def upsert_sessions(batch: Dict[int, str]):
+    return await supabase_upsert("telegram_sessions", [
+        {"telegram_chat_id": str(chat_id), "bot_id": bot_id}
+        for chat_id, bot_id in batch.items()
+    ])
+
+
+async def flush_pending_sessions():
+    """Writes every queued mapping in a single bulk upsert.
+
+    If Supabase rejects the batch, its rows are retried one by one, so a
+    bad row only holds back itself. Rows that weren't written (Supabase
+    unreachable, or the flush was cancelled) go back into the queue.
+    """
+    if not PENDING_SESSIONS:
+        return
+
+    unsent = dict(PENDING_SESSIONS)
+    PENDING_SESSIONS.clear()
+    rejected: Dict[int, str] = {}
+    try:
+        if await upsert_sessions(unsent) is not None:
+            for chat_id in unsent:
+                SESSION_REJECTS.pop(chat_id, None)
+            unsent = {}
+        elif len(unsent) == 1:
+            rejected, unsent = unsent, {}
+        else:
+            for chat_id, bot_id in list(unsent.items()):
+                if await upsert_sessions({chat_id: bot_id}) is None:
+                    rejected[chat_id] = bot_id
+                else:
+                    SESSION_REJECTS.pop(chat_id, None)
+                del unsent[chat_id]
+    except httpx.HTTPError as e:
+        logger.warning("Supabase UPSERT telegram_sessions failed: %r", e)
+    finally:
+        # Also runs on cancellation. setdefault: a newer /start queued for
+        # the same chat meanwhile wins.
+        for chat_id, bot_id in unsent.items():
+            PENDING_SESSIONS.setdefault(chat_id, bot_id)
+        for chat_id, bot_id in rejected.items():
+            rejects = SESSION_REJECTS.get(chat_id, 0) + 1
+            if rejects >= SESSION_MAX_REJECTS:
+                logger.error("Dropping telegram_sessions row %s → %s after %d rejections", chat_id, bot_id, rejects)
+                SESSION_REJECTS.pop(chat_id, None)
+            else:
+                SESSION_REJECTS[chat_id] = rejects
+                PENDING_SESSIONS.setdefault(chat_id, bot_id)
+
+
+async def session_flush_loop():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        try:
+            await flush_pending_sessions()
+        except Exception:
+            logger.exception("Flushing telegram_sessions failed")
+
+
+async def get_bot_for_chat(chat_id: int) -> str | None:
+    """Resolves chat → bot_id: CHAT_TO_BOT, then Redis, then Supabase.
+
+    On a miss the bot's config_json is embedded in the same PostgREST call (via the
+    telegram_sessions.bot_id → bots.id foreign key), so the handler's
+    following get_menu_for_bot() is a cache hit, not a second round-trip.
+    If the embed fails we retry with the plain bot_id select.
+    """
+    cached = CHAT_TO_BOT.get(chat_id)
+    if cached:
+        return cached
+
+    # The latest /start on any worker
+    shared = await redis_get_json(REDIS_CHAT_KEY.format(chat_id))
+    if isinstance(shared, str) and shared:
+        CHAT_TO_BOT[chat_id] = shared
+        return shared
+
+    # Started here but not flushed to Supabase yet
+    pending = PENDING_SESSIONS.get(chat_id)
+    if pending:
+        return pending
+
+    rows = await supabase_get("telegram_sessions", {
         "telegram_chat_id": f"eq.{chat_id}",
-        "select": "bot_id"
+        "select": "bot_id,bots(config_json)"
     })
-    if rows and rows[0].get("bot_id"):
-        return rows[0]["bot_id"]
-    return None
+    if rows is None:
+        # Embedding needs the FK; if PostgREST can't resolve it (PGRST200,
+        # a 400) still answer the chat, the config then loads on its own
+        rows = await supabase_get("telegram_sessions", {
+            "telegram_chat_id": f"eq.{chat_id}",
+            "select": "bot_id"
+        })
+    if not rows or not rows[0].get("bot_id"):
+        return None
+
+    bot_id = rows[0]["bot_id"]
+    CHAT_TO_BOT[chat_id] = bot_id
+    # Write-if-absent: a /start elsewhere may have landed since our GET, and
+    # this Supabase row is older than that. assign_chat_to_bot() overwrites.
+    await redis_set_json(REDIS_CHAT_KEY.format(chat_id), bot_id, CHAT_REDIS_TTL, nx=True)
+    if bot_id not in BOT_CACHE:
+        cache_bot_config(bot_id, (rows[0].get("bots") or {}).get("config_json"))
+    return bot_id
+
+
+# ============================================================
+#   TELEGRAM UPDATE MODELS
+# ============================================================
+# Only the fields the handlers read; everything else in the update is
+# ignored by pydantic rather than walked with nested .get() calls.
+
+class TgChat(BaseModel):
+    id: int
+
+
+class TgMessage(BaseModel):
+    chat: TgChat
+    text: str = ""
+
+
+class TgCallbackQuery(BaseModel):
+    id: str
+    data: str = ""
+    message: TgMessage | None = None  # absent for inline-mode messages
+
+
+class TgUpdate(BaseModel):
+    update_id: int = 0
+    message: TgMessage | None = None
+    callback_query: TgCallbackQuery | None = None
 
 
 # ============================================================
 #   TELEGRAM WEBHOOK
 # ============================================================
 
+def json_response(data, status_code: int = 200) -> Response:
+    return Response(orjson.dumps(data), status_code=status_code, media_type="application/json")
+
+
+def update_chat_id(update: TgUpdate) -> int | None:
+    msg = update.message or (update.callback_query and update.callback_query.message)
+    return msg.chat.id if msg else None
+
+
+def allow_update(chat_id: int) -> bool:
+    """Token bucket per chat: RATE_LIMIT_BURST deep, refilled per minute."""
+    now = time.monotonic()
+    tokens, last = RATE_BUCKETS.get(chat_id, (RATE_LIMIT_BURST, now))
+    tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * RATE_LIMIT_PER_MIN / 60)
+    if tokens < 1:
+        RATE_BUCKETS[chat_id] = (tokens, now)
+        return False
+
+    RATE_BUCKETS[chat_id] = (tokens - 1, now)
+    return True
+
+
+async def read_body_capped(request: Request, limit: int) -> bytes | None:
+    """Returns the body, or None as soon as it is known to exceed limit."""
+    declared = request.headers.get("content-length")
+    if declared is not None and (not declared.isdigit() or int(declared) > limit):
+        return None
+
+    # Content-Length can be absent (chunked) or lie, so count while reading
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+def spawn(coro) -> asyncio.Task:
+    """Schedules coro on the loop without awaiting it."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+async def drain_background_tasks(timeout: float):
+    """Waits up to timeout for spawned tasks, including ones they spawn meanwhile."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while BACKGROUND_TASKS:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            logger.warning("Shutting down with %d updates still in flight", len(BACKGROUND_TASKS))
+            return
+        await asyncio.wait(set(BACKGROUND_TASKS), timeout=remaining)
+
+
+async def process_update(update: TgUpdate):
+    """Dispatches one update; runs after the webhook has already answered."""
+    try:
+        async with UPDATE_SLOTS:
+            if update.message:
+                await handle_message(update.message)
+
+            if update.callback_query and update.callback_query.message:
+                await handle_callback(update.callback_query)
+    except Exception:
+        logger.exception("Failed to process Telegram update %s", update.update_id)
+
+
 @app.post("/telegram-webhook")
 async def telegram_webhook(request: Request):
-    update = await request.json()
-    print("Incoming Telegram update:", update)
+    # Spoofed requests are dropped before the body is even read
+    if TELEGRAM_WEBHOOK_SECRET:
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        # As bytes: compare_digest raises TypeError on non-ASCII str
+        if not hmac.compare_digest(token.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+            return json_response({"ok": False}, status_code=401)
 
-    if "message" in update:
-        await handle_message(update["message"])
+    body = await read_body_capped(request, MAX_UPDATE_BYTES)
+    if body is None:
+        return json_response({"ok": False}, status_code=413)
 
-    if "callback_query" in update:
-        await handle_callback(update["callback_query"])
-
-    return JSONResponse({"ok": True})
+    try:
+        # Parsed and validated in one pass by pydantic-core, straight from bytes
+        update = TgUpdate.model_validate_json(body)
+    except ValidationError as e:
+        # Still a 200: Telegram redelivers anything else, and this body
+        # won't parse any better the next time
+        logger.warning("Dropping malformed Telegram update: %s", e)
+        return json_response({"ok": False})
+    logger.debug("Telegram update %s", update.update_id)
+
+    # edited_message, my_chat_member, ... parse to neither field; nothing to do
+    if update.message is None and update.callback_query is None:
+        return json_response({"ok": True})
+
+    # Spam / retry storms stop here, before any Supabase or Telegram call
+    chat_id = update_chat_id(update)
+    if chat_id is not None and not allow_update(chat_id):
+        if update.callback_query is not None:
+            # Dropped or not, the tapped button spins until it's answered
+            spawn(tg_answer_callback(update.callback_query.id))
+        return json_response({"ok": True, "rate_limited": True})
+
+    # Ack right away so Telegram doesn't hold the delivery slot (or retry)
+    # while we talk to Supabase and send replies.
+    spawn(process_update(update))
+
+    return json_response({"ok": True})
 
 
 # ============================================================
 #   HANDLE MESSAGES
 # ============================================================
 
-async def handle_message(msg: Dict[str, Any]):
-    chat_id = msg["chat"]["id"]
-    text = msg.get("text", "").strip()
+async def handle_message(msg: TgMessage):
+    chat_id = msg.chat.id
+    text = msg.text.strip()
 
     # -------- Case 1: /start with bot_id --------
     if text.startswith("/start "):
-        bot_id = text.split(" ", 1)[1].strip()
-        print("User started bot:", bot_id)
+        bot_id = text.removeprefix("/start ").strip()
+        logger.info("Chat %s started bot %s", chat_id, bot_id)
 
-        config = load_bot_config(bot_id)
-        if not config:
-            tg_send_message(chat_id, "❌ هذا الرابط غير صالح.\nالرجاء طلب الرابط الصحيح من صاحب المطعم.")
+        cfg = await load_bot_config(bot_id)
+        if cfg is None:
+            await tg_send_message(chat_id, "❌ هذا الرابط غير صالح.\nالرجاء طلب الرابط الصحيح من صاحب المطعم.")
             return
 
-        # Save mapping
-        assign_chat_to_bot(chat_id, bot_id)
-
-        # Send welcome
-        restaurant = config.get("restaurantName", "المطعم")
-        tagline = config.get("restaurantTagline", "")
-        opening = config.get("openingHours", "")
-
-        msg = f"👋 أهلاً بك في <b>{restaurant}</b>!\n"
-        if tagline:
-            msg += f"✨ {tagline}\n"
-        if opening:
-            msg += f"\n⏰ ساعات العمل: {opening}"
-        msg += "\n\nاستخدم الأزرار بالأسفل لعرض المنيو 👇"
-
-        tg_send_message(chat_id, msg, reply_markup=main_keyboard())
+        # Supabase gets it with the next bulk upsert; only Redis is awaited
+        await assign_chat_to_bot(chat_id, bot_id)
+        await tg_send_message(chat_id, cfg.welcome_html, reply_markup=MAIN_KEYBOARD)
         return
 
     # -------- Case 2: /start without parameter --------
     if text == "/start":
         # If we already know the bot, it's OK
-        known_bot = get_bot_for_chat(chat_id)
+        known_bot = await get_bot_for_chat(chat_id)
         if known_bot:
-            config = load_bot_config(known_bot)
-            name = config.get("restaurantName", "مطعمك")
-            tg_send_message(chat_id, f"مرحباً من جديد! 👋\nأنت تتحدث مع <b>{name}</b>.") 
+            cfg = await load_bot_config(known_bot)
+            name = (cfg and cfg.restaurant_name) or "مطعمك"
+            await tg_send_message(chat_id, f"مرحباً من جديد! 👋\nأنت تتحدث مع <b>{name}</b>.") 
             return
 
         # Otherwise => reject
-        tg_send_message(chat_id, "❌ هذا الرابط غير صالح.\nالرجاء استخدام الرابط الرسمي الخاص بالمطعم.")
+        await tg_send_message(chat_id, "❌ هذا الرابط غير صالح.\nالرجاء استخدام الرابط الرسمي الخاص بالمطعم.")
         return
 
     # -------- Normal Messages --------
-    bot_id = get_bot_for_chat(chat_id)
+    bot_id = await get_bot_for_chat(chat_id)
     if not bot_id:
-        tg_send_message(chat_id, "❌ يرجى الدخول عبر رابط المطعم.")
+        await tg_send_message(chat_id, "❌ يرجى الدخول عبر رابط المطعم.")
         return
 
-    menu = get_menu_for_bot(bot_id)
+    menu = await get_menu_for_bot(bot_id)
 
     if text == "🧾 عرض المنيو":
-        tg_send_message(chat_id, "اختر القسم:", reply_markup=categories_keyboard(menu))
+        await tg_send_message(chat_id, "اختر القسم:", reply_markup=menu["categories_keyboard"])
         return
 
-    tg_send_message(chat_id, "استخدم الأزرار 👇", reply_markup=main_keyboard())
+    await tg_send_message(chat_id, "استخدم الأزرار 👇", reply_markup=MAIN_KEYBOARD)
 
 
 # ============================================================
 #   HANDLE CALLBACKS
 # ============================================================
 
-async def handle_callback(callback: Dict[str, Any]):
-    chat_id = callback["message"]["chat"]["id"]
-    data = callback.get("data", "")
+async def handle_callback(callback: TgCallbackQuery):
+    chat_id = callback.message.chat.id
+    data = callback.data
+
+    # Telegram keeps the button spinning until answered; don't make it
+    # wait for the replies below.
+    spawn(tg_answer_callback(callback.id))
 
-    bot_id = get_bot_for_chat(chat_id)
+    bot_id = await get_bot_for_chat(chat_id)
     if not bot_id:
-        tg_send_message(chat_id, "❌ يرجى الدخول عبر رابط المطعم.")
+        await tg_send_message(chat_id, "❌ يرجى الدخول عبر رابط المطعم.")
         return
 
-    menu = get_menu_for_bot(bot_id)
+    menu = await get_menu_for_bot(bot_id)
 
     if data.startswith("CAT:"):
         cat_id = data.split(":", 1)[1]
-        category = next((c for c in menu if c["id"] == cat_id), None)
+        category = menu["categories_by_id"].get(cat_id)
 
         if not category:
-            tg_send_message(chat_id, "⚠ القسم غير موجود.")
+            await tg_send_message(chat_id, "⚠ القسم غير موجود.")
             return
 
-        tg_send_message(chat_id, f"📂 قسم <b>{category['name']}</b>:")
+        # Header first so it always lands above the cards
+        await tg_send_message(chat_id, f"📂 قسم <b>{category.name}</b>:")
 
-        for item in category["items"]:
-            price = f"{item['price']:.2f}$" if item["price"] > 0 else "حسب الطلب"
-            caption = f"<b>{item['name']}</b>\n{item['description']}\n💰 {price}"
+        # One at a time: cards arrive in menu order, and Telegram answers
+        # parallel sends to a single chat with 429s anyway. One failed
+        # card doesn't stop the rest.
+        for item in category.items:
+            try:
+                await send_item_card(chat_id, item)
+            except httpx.HTTPError as e:
+                logger.warning("Sending item %s to chat %s failed: %r", item.id, chat_id, e)
 
-            kb = {
-                "inline_keyboard": [
-                    [{"text": "➕ أضف للسلة", "callback_data": f"ADD:{item['id']}"}]
-                ]
-            }
+        return
 
-            if item.get("imageUrl"):
-                tg_send_photo(chat_id, item["imageUrl"], caption, kb)
-            else:
-                tg_send_message(chat_id, caption, kb)
 
-        return
+async def send_item_card(chat_id: int, item: MenuItem):
+    if item.image_url:
+        await tg_send_photo(chat_id, item.image_url, item.caption, item.card_keyboard)
+    else:
+        await tg_send_message(chat_id, item.caption, item.card_keyboard)
 
 
 # ============================================================
 #   KEYBOARDS
 # ============================================================
 
-def main_keyboard():
-    return {
-        "keyboard": [
-            [{"text": "🧾 عرض المنيو"}],
-        ],
-        "resize_keyboard": True
-    }
+# Keyboards are serialized once into orjson.Fragment: tg_post() splices the
+# ready bytes into the request body instead of re-encoding the dict each send.
 
+# Static, so build it once instead of on every reply
+MAIN_KEYBOARD = orjson.Fragment(orjson.dumps({
+    "keyboard": [
+        [{"text": "🧾 عرض المنيو"}],
+    ],
+    "resize_keyboard": True
+}))
 
-def categories_keyboard(menu):
+
+def categories_keyboard(menu) -> orjson.Fragment:
     rows = []
     for cat in menu:
-        rows.append([{"text": cat["name"], "callback_data": f"CAT:{cat['id']}"}])
+        rows.append([{"text": cat.name, "callback_data": f"CAT:{cat.id}"}])
 
-    return {
+    return orjson.Fragment(orjson.dumps({
         "inline_keyboard": rows
-    }
+    }))
+
+
+def item_card_keyboard(item_id: str) -> orjson.Fragment:
+    return orjson.Fragment(orjson.dumps({
+        "inline_keyboard": [
+            [{"text": "➕ أضف للسلة", "callback_data": f"ADD:{item_id}"}]
+        ]
+    }))
+
+
+# ============================================================
+#   INTERNAL
+# ============================================================
+
+@app.post("/internal/flush-bot-cache")
+async def internal_flush_bot_cache(request: Request, bot_id: str | None = None):
+    """Called by the dashboard after it edits a bot's config_json."""
+    token = request.headers.get("x-internal-token", "")
+    if not INTERNAL_API_TOKEN or not hmac.compare_digest(token.encode(), INTERNAL_API_TOKEN.encode()):
+        return json_response({"ok": False}, status_code=403)
+
+    await flush_bot_cache(bot_id)
+    return json_response({"ok": True})
+
+
+@app.get("/metrics")
+def metrics():
+    """Cache hit/miss counters in Prometheus text format."""
+    lines = []
+    for cache, size in (("bot", len(BOT_CACHE)), ("menu", len(MENU_CACHE))):
+        lines.append(f'acspro_cache_hits_total{{cache="{cache}"}} {CACHE_STATS[cache + "_hit"]}')
+        lines.append(f'acspro_cache_misses_total{{cache="{cache}"}} {CACHE_STATS[cache + "_miss"]}')
+        lines.append(f'acspro_cache_entries{{cache="{cache}"}} {size}')
+    return PlainTextResponse("\n".join(lines) + "\n")
 
 
 # ============================================================
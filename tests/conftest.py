@@ -0,0 +1,123 @@
+import asyncio
+import functools
+import os
+import sys
+
+import httpx
+import orjson
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test-token")
+os.environ.setdefault("SUPABASE_URL", "https://supabase.test")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "test-key")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import main  # noqa: E402
+
+
+class FakeBackend:
+    """In-memory Supabase REST + Telegram Bot API behind one MockTransport."""
+
+    def __init__(self):
+        self.bots = {}          # bot_id -> config_json
+        self.sessions = {}      # telegram_chat_id (str) -> bot_id
+        self.reject_bots = set()  # upserts naming these bots get a 400
+        self.embed_fk = True    # False: bots(config_json) embedding 400s
+        self.supa_delay = 0.0
+        self.tg_delay = 0.0
+        self.tg_responses = []  # canned replies served before the default 200
+        self.supa_calls = []    # (method, table, params)
+        self.sent = []          # (Bot API method, payload)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.host == "api.telegram.org":
+            return await self.telegram(request)
+        return await self.supabase(request)
+
+    async def telegram(self, request):
+        await asyncio.sleep(self.tg_delay)
+        if self.tg_responses:
+            return self.tg_responses.pop(0)
+        self.sent.append((request.url.path.rsplit("/", 1)[-1], orjson.loads(request.content)))
+        return httpx.Response(200, json={"ok": True})
+
+    async def supabase(self, request):
+        table = request.url.path.rsplit("/", 1)[-1]
+        params = dict(request.url.params)
+        self.supa_calls.append((request.method, table, params))
+        await asyncio.sleep(self.supa_delay)
+
+        if request.method == "POST":
+            rows = orjson.loads(request.content)
+            if any(row["bot_id"] in self.reject_bots for row in rows):
+                return httpx.Response(400, json={"message": "rejected"})
+            for row in rows:
+                self.sessions[row["telegram_chat_id"]] = row["bot_id"]
+            return httpx.Response(201)
+
+        if table == "bots":
+            bot_id = params["id"].removeprefix("eq.")
+            if bot_id not in self.bots:
+                return httpx.Response(200, json=[])
+            return httpx.Response(200, json=[{"id": bot_id, "config_json": self.bots[bot_id]}])
+
+        chat_id = params["telegram_chat_id"].removeprefix("eq.")
+        bot_id = self.sessions.get(chat_id)
+        if bot_id is None:
+            return httpx.Response(200, json=[])
+        if "bots(" in params["select"]:
+            if not self.embed_fk:
+                return httpx.Response(400, json={"code": "PGRST200"})
+            return httpx.Response(200, json=[{"bot_id": bot_id, "bots": {"config_json": self.bots.get(bot_id)}}])
+        return httpx.Response(200, json=[{"bot_id": bot_id}])
+
+    def texts(self):
+        return [payload.get("text") or payload.get("caption") for _, payload in self.sent]
+
+
+class FakeRedis:
+    """The slice of redis.asyncio.Redis the helpers use; ignores expiry."""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    for cache in (main.BOT_CACHE, main.MENU_CACHE, main.CHAT_TO_BOT, main.PENDING_SESSIONS,
+                  main.SESSION_REJECTS, main.RATE_BUCKETS, main.BOT_LOADS):
+        cache.clear()
+    # Tests flush explicitly unless they shorten this themselves
+    monkeypatch.setattr(main, "SESSION_FLUSH_INTERVAL", 3600.0)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    """Routes the clients lifespan() opens to a FakeBackend."""
+    fake = FakeBackend()
+    transport = httpx.MockTransport(fake.handle)
+    monkeypatch.setattr(httpx, "AsyncClient", functools.partial(httpx.AsyncClient, transport=transport))
+    return fake
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """Stands in for the shared Redis; lifespan() leaves it be with REDIS_URL unset."""
+    fake = FakeRedis()
+    monkeypatch.setattr(main, "REDIS", fake)
+    return fake
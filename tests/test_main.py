@@ -0,0 +1,232 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import orjson
+from fastapi.testclient import TestClient
+
+import main
+
+CONFIG = {
+    "restaurantName": "Demo",
+    "menu": [
+        {"id": "drinks", "name": "Drinks", "items": [
+            {"id": "tea", "name": "Tea", "price": 2},
+            {"id": "coffee", "name": "Coffee", "price": 3},
+        ]},
+    ],
+}
+
+
+def message_update(text, chat_id=100):
+    return {"update_id": 1, "message": {"chat": {"id": chat_id}, "text": text}}
+
+
+async def served(coro_fn):
+    """Runs coro_fn() between lifespan() startup and shutdown."""
+    async with main.lifespan(main.app):
+        return await coro_fn()
+
+
+# ---- bot config loading ----
+
+def test_concurrent_misses_share_one_fetch(backend):
+    backend.bots["b1"] = CONFIG
+    backend.supa_delay = 0.05
+
+    async def load_many():
+        return await asyncio.gather(*(main.load_bot_config("b1") for _ in range(20)))
+
+    cfgs = asyncio.run(served(load_many))
+
+    assert len({id(cfg) for cfg in cfgs}) == 1
+    assert [call for call in backend.supa_calls if call[1] == "bots"] == [
+        ("GET", "bots", {"id": "eq.b1", "select": "config_json"})
+    ]
+    assert not main.BOT_LOADS
+
+
+def test_bad_menu_entries_do_not_break_start(backend):
+    backend.bots["b1"] = {"restaurantName": "Demo", "menu": [
+        {"id": "drinks", "name": "Drinks", "items": [
+            {"id": "tea", "name": "Tea", "price": "7"},
+            {"name": "no id"},
+        ]},
+        {"id": "empty", "name": "No items key"},
+    ]}
+
+    async def start():
+        await main.handle_message(main.TgMessage.model_validate(message_update("/start b1")["message"]))
+        return await main.get_menu_for_bot("b1")
+
+    menu = asyncio.run(served(start))
+
+    assert "Demo" in backend.texts()[0]
+    [category] = menu["categories"]
+    assert [(item.id, item.price) for item in category.items] == [("tea", 7.0)]
+
+
+# ---- redis ----
+
+def test_unresponsive_redis_falls_back_to_supabase(backend, monkeypatch):
+    backend.sessions["5"] = "b1"
+    monkeypatch.setattr(main, "REDIS", None)  # lifespan() replaces it; restored after
+    monkeypatch.setattr(main, "REDIS_TIMEOUT", 0.1)
+
+    async def lookup_against_blackhole():
+        # Accepts connections, never answers
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(main, "REDIS_URL", f"redis://127.0.0.1:{port}")
+        try:
+            return await served(lambda: asyncio.wait_for(main.get_bot_for_chat(5), timeout=2))
+        finally:
+            server.close()
+
+    assert asyncio.run(lookup_against_blackhole()) == "b1"
+    assert ("GET", "telegram_sessions") in [call[:2] for call in backend.supa_calls]
+
+
+def test_stale_read_never_overwrites_newer_mapping(backend, redis):
+    backend.sessions["5"] = "b1"  # flushed from an earlier /start
+    backend.supa_delay = 0.05
+    key = main.REDIS_CHAT_KEY.format(5)
+
+    async def lookup_racing_a_start():
+        lookup = asyncio.create_task(main.get_bot_for_chat(5))
+        await asyncio.sleep(0.01)  # past the Redis miss, Supabase in flight
+        redis.data[key] = orjson.dumps("b2")  # another worker's /start b2
+        return await lookup
+
+    assert asyncio.run(served(lookup_racing_a_start)) == "b1"
+    assert orjson.loads(redis.data[key]) == "b2"
+
+
+# ---- chat → bot mapping ----
+
+def test_session_lookup_falls_back_without_embed(backend):
+    backend.embed_fk = False
+    backend.sessions["5"] = "b1"
+
+    assert asyncio.run(served(lambda: main.get_bot_for_chat(5))) == "b1"
+
+
+def test_cancelled_flush_is_written_on_shutdown(backend, monkeypatch):
+    monkeypatch.setattr(main, "SESSION_FLUSH_INTERVAL", 0.01)
+    backend.supa_delay = 0.2
+
+    async def start_then_stop_mid_flush():
+        await main.assign_chat_to_bot(1, "b1")
+        await asyncio.sleep(0.05)  # the loop's upsert is now in flight
+
+    asyncio.run(served(start_then_stop_mid_flush))
+
+    assert backend.sessions == {"1": "b1"}
+    assert not main.PENDING_SESSIONS
+
+
+def test_rejected_row_does_not_hold_back_the_rest(backend):
+    backend.reject_bots.add("bad")
+
+    async def flush_rounds():
+        for chat_id, bot_id in ((1, "b1"), (2, "bad"), (3, "b3")):
+            await main.assign_chat_to_bot(chat_id, bot_id)
+        await main.flush_pending_sessions()
+        first_round = dict(main.PENDING_SESSIONS)
+        for _ in range(main.SESSION_MAX_REJECTS - 1):
+            await main.flush_pending_sessions()
+        return first_round
+
+    first_round = asyncio.run(served(flush_rounds))
+
+    assert backend.sessions == {"1": "b1", "3": "b3"}
+    assert first_round == {2: "bad"}
+    assert not main.PENDING_SESSIONS
+
+
+# ---- Telegram ----
+
+def test_rate_limited_send_is_retried(backend):
+    backend.tg_responses.append(httpx.Response(429, json={"ok": False, "parameters": {"retry_after": 0}}))
+
+    asyncio.run(served(lambda: main.tg_send_message(1, "hi")))
+
+    assert backend.sent == [("sendMessage", {"chat_id": 1, "text": "hi", "parse_mode": "HTML"})]
+
+
+# ---- webhook ----
+
+def test_shutdown_waits_for_acked_updates(backend):
+    backend.bots["b1"] = CONFIG
+    backend.tg_delay = 0.2
+
+    with TestClient(main.app) as client:
+        resp = client.post("/telegram-webhook", json=message_update("/start b1"))
+        assert resp.status_code == 200
+
+    assert [method for method, _ in backend.sent] == ["sendMessage"]
+    assert backend.sessions == {"100": "b1"}
+
+
+def test_non_ascii_secret_is_rejected_not_500(backend, monkeypatch):
+    monkeypatch.setattr(main, "TELEGRAM_WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(main, "INTERNAL_API_TOKEN", "t0ken")
+    spoofed = "sécret".encode()
+
+    with TestClient(main.app) as client:
+        webhook = client.post("/telegram-webhook", json=message_update("/start b1"),
+                              headers={"x-telegram-bot-api-secret-token": spoofed})
+        flush = client.post("/internal/flush-bot-cache", headers={"x-internal-token": spoofed})
+
+    assert webhook.status_code == 401
+    assert flush.status_code == 403
+    assert not backend.sent
+
+
+def test_malformed_update_is_acked(backend):
+    with TestClient(main.app) as client:
+        resp = client.post("/telegram-webhook", content=b"{not json")
+
+    assert resp.status_code == 200
+    assert not backend.sent
+
+
+def test_oversized_body_is_rejected(backend):
+    too_big = b"x" * (main.MAX_UPDATE_BYTES + 1)
+
+    def chunks():
+        yield too_big[:1024]
+        yield too_big[1024:]
+
+    with TestClient(main.app) as client:
+        declared = client.post("/telegram-webhook", content=too_big)
+        chunked = client.post("/telegram-webhook", content=chunks())
+
+    assert declared.status_code == 413
+    assert chunked.status_code == 413
+
+
+def test_rate_limited_callback_is_still_answered(backend, monkeypatch):
+    monkeypatch.setattr(main, "allow_update", lambda chat_id: False)
+    tap = {"update_id": 2, "callback_query": {
+        "id": "cb1", "data": "menu", "message": {"chat": {"id": 100}}}}
+
+    with TestClient(main.app) as client:
+        resp = client.post("/telegram-webhook", json=tap)
+
+    assert resp.json() == {"ok": True, "rate_limited": True}
+    assert backend.sent == [("answerCallbackQuery", {"callback_query_id": "cb1"})]
+
+
+def test_token_bucket_refills_per_minute(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    burst = int(main.RATE_LIMIT_BURST)
+    assert all(main.allow_update(1) for _ in range(burst))
+    assert not main.allow_update(1)
+    assert main.allow_update(2)  # buckets are per chat
+
+    now[0] += 60 / main.RATE_LIMIT_PER_MIN  # one token back
+    assert main.allow_update(1)
+    assert not main.allow_update(1)